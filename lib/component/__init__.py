@@ -1,7 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-from .net import create_net
+from .net import create_net, script_net
 from .criterion import set_criterion
 from .optimizer import set_optimizer
 from .loss import set_loss_store
@@ -9,6 +9,7 @@ from .likelihood import set_likelihood
 
 __all__ = [
             'create_net',
+            'script_net',
             'set_criterion',
             'set_optimizer',
             'set_loss_store',
@@ -118,7 +118,9 @@ class NegativeLogLikelihood(nn.Module):
         num_occurs = torch.sum(label)
 
         if num_occurs.item() == 0.0:
-            loss = torch.tensor([1e-7], requires_grad=True).to(self.device)  # To avoid zero division, set small value as loss
+            # To avoid zero division, set small value as loss.
+            # Loss is connected to output, so that all parameters get gradient, which DistributedDataParallel waits for.
+            loss = output.sum() * 0 + 1e-7
             return loss
         else:
             neg_log_loss = -torch.sum((output - _loss) * label) / num_occurs
@@ -171,13 +173,11 @@ class ClsCriterion:
 
         # loss for each label and total of their losses
         losses = dict()
-        losses['total'] = torch.tensor([0.0], requires_grad=True).to(self.device)
         for label_name in labels['labels'].keys():
             _output = outputs[label_name]
             _label = _labels[label_name]
-            _label_loss = self.criterion(_output, _label)
-            losses[label_name] = _label_loss
-            losses['total'] = torch.add(losses['total'], _label_loss)
+            losses[label_name] = self.criterion(_output, _label)
+        losses['total'] = torch.stack(list(losses.values())).sum()
         return losses
 
 
@@ -235,13 +235,11 @@ class RegCriterion:
 
         # loss for each label and total of their losses
         losses = dict()
-        losses['total'] = torch.tensor([0.0], requires_grad=True).to(self.device)
         for label_name in labels['labels'].keys():
             _output = _outputs[label_name]
             _label = _labels[label_name]
-            _label_loss = self.criterion(_output, _label)
-            losses[label_name] = _label_loss
-            losses['total'] = torch.add(losses['total'], _label_loss)
+            losses[label_name] = self.criterion(_output, _label)
+        losses['total'] = torch.stack(list(losses.values())).sum()
         return losses
 
 
@@ -294,13 +292,11 @@ class DeepSurvCriterion:
 
         # loss for each label and total of their losses
         losses = dict()
-        losses['total'] = torch.tensor([0.0], requires_grad=True).to(self.device)
         for label_name in labels['labels'].keys():
             _output = outputs[label_name]
             _label = _labels[label_name]
-            _label_loss = self.criterion(_output, _label, _periods, _network)
-            losses[label_name] = _label_loss
-            losses['total'] = torch.add(losses['total'], _label_loss)
+            losses[label_name] = self.criterion(_output, _label, _periods, _network)
+        losses['total'] = torch.stack(list(losses.values())).sum()
         return losses
 
 
@@ -3,9 +3,10 @@
 
 from pathlib import Path
 import torch
+import torch.distributed as dist
 import pandas as pd
 from ..logger import BaseLogger
-from typing import List, Dict, Union
+from typing import List, Dict
 
 
 logger = BaseLogger.get_logger(__name__)
@@ -13,60 +14,37 @@ logger = BaseLogger.get_logger(__name__)
 
 class LabelLoss:
     """
-    Class to store loss for every bash and epoch loss of each label.
+    Class to store epoch loss of each label.
     """
     def __init__(self) -> None:
-        # Accumulate batch_loss(=loss * batch_size)
-        self.train_batch_loss = 0.0
-        self.val_batch_loss = 0.0
-
         # epoch_loss = batch_loss / dataset_size
-        self.train_epoch_loss = []       # List[float]
-        self.val_epoch_loss = []         # List[float]
+        self.epoch_loss = {'train': [], 'val': []}  # Dict[str, List[float]]
 
         self.best_val_loss = None        # float
         self.best_epoch = None           # int
         self.is_val_loss_updated = None  # bool
 
-    def get_loss(self, phase: str, target: str) -> Union[float, List[float]]:
+    def get_epoch_loss(self, phase: str) -> List[float]:
         """
-        Return loss depending on phase and target
+        Return epoch losses of phase.
 
         Args:
             phase (str): 'train' or 'val'
-            target (str): 'batch' or 'epoch'
 
         Returns:
-            Union[float, List[float]]: batch_loss or epoch_loss
-        """
-        _target = phase + '_' + target + '_loss'
-        return getattr(self, _target)
-
-    def store_batch_loss(self, phase: str, new_batch_loss: torch.FloatTensor, batch_size: int) -> None:
+            List[float]: epoch losses
         """
-        Add new batch loss to previous one for phase by multiplying by batch_size.
-
-        Args:
-            phase (str): 'train' or 'val'
-            new_batch_loss (torch.FloatTensor): batch loss calculated by criterion
-            batch_size (int): batch size
-        """
-        _new = new_batch_loss.item() * batch_size  # torch.FloatTensor -> float
-        _prev = self.get_loss(phase, 'batch')
-        _added = _prev + _new
-        _target = phase + '_' + 'batch_loss'
-        setattr(self, _target, _added)
+        return self.epoch_loss[phase]
 
     def append_epoch_loss(self, phase: str, new_epoch_loss: float) -> None:
         """
-        Append epoch loss depending on phase and target
+        Append epoch loss depending on phase.
 
         Args:
             phase (str): 'train' or 'val'
-            new_epoch_loss (float): batch loss or epoch loss
+            new_epoch_loss (float): epoch loss
         """
-        _target = phase + '_' + 'epoch_loss'
-        getattr(self, _target).append(new_epoch_loss)
+        self.epoch_loss[phase].append(new_epoch_loss)
 
     def get_latest_epoch_loss(self, phase: str) -> float:
         """
@@ -78,7 +56,7 @@ class LabelLoss:
         Returns:
             float: the latest loss
         """
-        return self.get_loss(phase, 'epoch')[-1]
+        return self.epoch_loss[phase][-1]
 
     def update_best_val_loss(self, at_epoch: int = None) -> None:
         """
@@ -107,23 +85,35 @@ class LossStore:
     """
     Class for calculating loss and store it.
     """
-    def __init__(self, label_list: List[str], num_epochs: int, dataset_info: Dict[str, int]) -> None:
+    def __init__(self, label_list: List[str], num_epochs: int, dataset_info: Dict[str, int], device: torch.device) -> None:
         """
         Args:
             label_list (List[str]): list of internal labels
             num_epochs (int) : number of epochs
             dataset_info (Dict[str, int]):  dataset sizes of 'train' and 'val'
+            device (torch.device): device on which batch losses are accumulated
         """
         self.label_list = label_list
         self.num_epochs = num_epochs
         self.dataset_info = dataset_info
+        self.device = device
 
         # Added a special label 'total' to store total of losses of all labels.
         self.label_losses = {label_name: LabelLoss() for label_name in self.label_list + ['total']}
 
+        # Batch losses of all labels are accumulated in a tensor, whose position is indicated by label_idx.
+        self.label_idx = {label_name: i for i, label_name in enumerate(self.label_list + ['total'])}
+        self.batch_loss = {phase: torch.zeros(len(self.label_idx), device=self.device) for phase in ['train', 'val']}
+        # Number of samples whose losses are accumulated, which includes samples padded by DistributedSampler.
+        self.num_samples = {phase: torch.zeros((), device=self.device) for phase in ['train', 'val']}
+
+        # Each label is averaged by the number of samples, and total by it and the number of labels.
+        self._num_averaged = torch.tensor([1.0] * len(self.label_list) + [float(len(self.label_list))], device=self.device)
+
     def store(self, phase: str, losses: Dict[str, torch.FloatTensor], batch_size: int = None) -> None:
         """
         Store label-wise batch losses of phase to previous one.
+        Batch losses are kept on device, so that no synchronization with GPU occurs for every batch.
 
         Args:
             phase (str): 'train' or 'val'
@@ -131,12 +121,12 @@ class LossStore:
             batch_size (int): batch size
 
         # Note:
-            self.loss_stores['total'] is already total of losses of all label, which is calculated in criterion.py,
-            therefore, it is OK just to multiply by batch_size. This is done in add_batch_loss().
+            losses['total'] is already total of losses of all label, which is calculated in criterion.py,
+            therefore, it is OK just to multiply by batch_size.
         """
-        for label_name in self.label_list + ['total']:
-            _new_batch_loss = losses[label_name]
-            self.label_losses[label_name].store_batch_loss(phase, _new_batch_loss, batch_size)
+        _new_batch_loss = torch.stack([losses[label_name].detach().reshape(()) for label_name in self.label_idx])
+        self.batch_loss[phase] += _new_batch_loss * batch_size
+        self.num_samples[phase] += batch_size
 
     def cal_epoch_loss(self, at_epoch: int = None) -> None:
         """
@@ -145,29 +135,23 @@ class LossStore:
         Args:
             at_epoch (int): epoch number
         """
-        # For each label
-        for label_name in self.label_list:
-            for phase in ['train', 'val']:
-                _batch_loss = self.label_losses[label_name].get_loss(phase, 'batch')
-                _dataset_size = self.dataset_info[phase]
-                _new_epoch_loss = _batch_loss / _dataset_size
-                self.label_losses[label_name].append_epoch_loss(phase, _new_epoch_loss)
-
-        # For total, average by dataset_size and the number of labels.
         for phase in ['train', 'val']:
-            _batch_loss = self.label_losses['total'].get_loss(phase, 'batch')
-            _dataset_size = self.dataset_info[phase]
-            _new_epoch_loss = _batch_loss / (_dataset_size * len(self.label_list))
-            self.label_losses['total'].append_epoch_loss(phase, _new_epoch_loss)
+            if dist.is_available() and dist.is_initialized():
+                # Sum up batch losses and samples accumulated by all processes of DistributedDataParallel.
+                dist.all_reduce(self.batch_loss[phase])
+                dist.all_reduce(self.num_samples[phase])
+            _new_epoch_loss = (self.batch_loss[phase] / (self._num_averaged * self.num_samples[phase])).tolist()
+            for label_name, i in self.label_idx.items():
+                self.label_losses[label_name].append_epoch_loss(phase, _new_epoch_loss[i])
 
         # Update val_best_loss and best_epoch.
         for label_name in self.label_list + ['total']:
             self.label_losses[label_name].update_best_val_loss(at_epoch=at_epoch)
 
-        # Initialize batch_loss after calculating epoch loss.
-        for label_name in self.label_list + ['total']:
-            self.label_losses[label_name].train_batch_loss = 0.0
-            self.label_losses[label_name].val_batch_loss = 0.0
+        # Initialize batch_loss in place after calculating epoch loss.
+        for phase in ['train', 'val']:
+            self.batch_loss[phase].zero_()
+            self.num_samples[phase].zero_()
 
     def is_val_loss_updated(self) -> bool:
         """
@@ -216,24 +200,23 @@ class LossStore:
         save_dir = Path(save_datetime_dir, 'learning_curve')
         save_dir.mkdir(parents=True, exist_ok=True)
 
+        # Build one DataFrame of all labels, and slice it for each label.
+        df_epoch_loss = pd.DataFrame({
+                                    (label_name, phase + '_loss'): self.label_losses[label_name].get_epoch_loss(phase)
+                                    for label_name in self.label_list + ['total']
+                                    for phase in ['train', 'val']
+                                })
+
         for label_name in self.label_list + ['total']:
             _label_loss = self.label_losses[label_name]
-            _train_epoch_loss = _label_loss.get_loss('train', 'epoch')
-            _val_epoch_loss = _label_loss.get_loss('val', 'epoch')
-
-            df_label_epoch_loss = pd.DataFrame({
-                                                'train_loss': _train_epoch_loss,
-                                                'val_loss': _val_epoch_loss
-                                            })
-
             _best_epoch = str(_label_loss.best_epoch).zfill(3)
             _best_val_loss = f"{_label_loss.best_val_loss:.4f}"
             save_name = 'learning_curve_' + label_name + '_val-best-epoch-' + _best_epoch + '_val-best-loss-' + _best_val_loss + '.csv'
             save_path = Path(save_dir, save_name)
-            df_label_epoch_loss.to_csv(save_path, index=False)
+            df_epoch_loss[label_name].to_csv(save_path, index=False)
 
 
-def set_loss_store(label_list: List[str], num_epochs: int, dataset_info: Dict[str, int]) -> LossStore:
+def set_loss_store(label_list: List[str], num_epochs: int, dataset_info: Dict[str, int], device: torch.device) -> LossStore:
     """
     Return class LossStore.
 
@@ -241,8 +224,9 @@ def set_loss_store(label_list: List[str], num_epochs: int, dataset_info: Dict[st
         label_list (List[str]): label list
         num_epochs (int) : number of epochs
         dataset_info (Dict[str, int]):  dataset sizes of 'train' and 'val'
+        device (torch.device): device
 
     Returns:
         LossStore: LossStore
     """
-    return LossStore(label_list, num_epochs, dataset_info)
+    return LossStore(label_list, num_epochs, dataset_info, device)
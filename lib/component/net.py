@@ -1,74 +1,173 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-r
 
-from collections import OrderedDict
+import os
 import torch
 import torch.nn as nn
 from torchvision.ops import MLP
 import torchvision.models as models
+from ..logger import BaseLogger
 from typing import Dict, Optional
 
 
+logger = BaseLogger.get_logger(__name__)
+
+
+class MultiClassifier(nn.Module):
+    """
+    Classifier for multi-label.
+    Classifiers of all labels are fused into a single nn.Linear,
+    whose output is split into the output of each label.
+    """
+    def __init__(
+                self,
+                in_features: int = None,
+                num_outputs_for_label: Dict[str, int] = None,
+                pre_module: Optional[nn.Module] = None
+                ) -> None:
+        """
+        Args:
+            in_features (int): number of input features
+            num_outputs_for_label (Dict[str, int]): number of outputs for each label
+            pre_module (Optional[nn.Module]): layers shared among labels before nn.Linear, eg. Dropout of EfficientNet. Defaults to None.
+        """
+        super().__init__()
+
+        self.label_list = list(num_outputs_for_label.keys())
+        self.splits = list(num_outputs_for_label.values())
+        self.pre_module = nn.Identity() if pre_module is None else pre_module
+        self.fc = nn.Linear(in_features, sum(self.splits))
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs) -> None:
+        """
+        Load weight, converting weight saved with a classifier for each label into the fused layout.
+        Previously, keys were '<label>.weight' (MLP, ResNet, DenseNet), '<label>.1.*' (EfficientNet),
+        '<label>.0.*' for LayerNorm and '<label>.2.*' (ConvNeXt), and '<label>.head.*' (ViT).
+
+        Args:
+            state_dict (Dict[str, torch.Tensor]): weight, which is converted in place
+            prefix (str): prefix of keys of this module
+        """
+        if (prefix + 'fc.weight') not in state_dict:
+            self._convert_legacy_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def _convert_legacy_state_dict(self, state_dict: Dict[str, torch.Tensor], prefix: str) -> None:
+        """
+        Concatenate weights and biases of nn.Linear of each label into fc in order of label_list,
+        and move LayerNorm shared among labels of ConvNeXt into pre_module.
+
+        Args:
+            state_dict (Dict[str, torch.Tensor]): weight, which is converted in place
+            prefix (str): prefix of keys of this module
+        """
+        # Prefix of nn.Linear within the classifier of each label
+        linear_prefixes = ['', 'head.', '2.', '1.']
+
+        linear_prefix_for_label = dict()
+        for label_name in self.label_list:
+            label_prefix = prefix + label_name + '.'
+            linear_prefix = next((label_prefix + p for p in linear_prefixes if (label_prefix + p + 'weight') in state_dict), None)
+            if linear_prefix is None:
+                # Not legacy weight, which is left to be reported as missing.
+                return
+            linear_prefix_for_label[label_name] = linear_prefix
+
+        weights = []
+        biases = []
+        for label_name, linear_prefix in linear_prefix_for_label.items():
+            label_prefix = prefix + label_name + '.'
+            weights.append(state_dict.pop(linear_prefix + 'weight'))
+            biases.append(state_dict.pop(linear_prefix + 'bias'))
+
+            # LayerNorm of ConvNeXt is the same module for all labels.
+            for param_name in ['weight', 'bias']:
+                _layer_norm_param = state_dict.pop(label_prefix + '0.' + param_name, None)
+                if (_layer_norm_param is not None) and (linear_prefix == label_prefix + '2.'):
+                    state_dict[prefix + 'pre_module.0.' + param_name] = _layer_norm_param
+
+        state_dict[prefix + 'fc.weight'] = torch.cat(weights, dim=0)
+        state_dict[prefix + 'fc.bias'] = torch.cat(biases, dim=0)
+
+    def forward(self, x: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """
+        Forward.
+
+        Args:
+            x (torch.Tensor): output from extractor
+
+        Returns:
+            Dict[str, torch.Tensor]: output of classifier of each label
+        """
+        x = self.pre_module(x)
+        x = self.fc(x)
+        output: Dict[str, torch.Tensor] = dict()
+        for label_name, label_output in zip(self.label_list, torch.split(x, self.splits, dim=1)):
+            output[label_name] = label_output
+        return output
+
+
 class BaseNet:
     """
     Class to construct network
     """
+    # Constructor and family of each network. Family decides how layers of network are accessed.
     cnn = {
-            'ResNet18': models.resnet18,
-            'ResNet': models.resnet50,
-            'DenseNet': models.densenet161,
-            'EfficientNetB0': models.efficientnet_b0,
-            'EfficientNetB2': models.efficientnet_b2,
-            'EfficientNetB4': models.efficientnet_b4,
-            'EfficientNetB6': models.efficientnet_b6,
-            'EfficientNetV2s': models.efficientnet_v2_s,
-            'EfficientNetV2m': models.efficientnet_v2_m,
-            'EfficientNetV2l': models.efficientnet_v2_l,
-            'ConvNeXtTiny': models.convnext_tiny,
-            'ConvNeXtSmall': models.convnext_small,
-            'ConvNeXtBase': models.convnext_base,
-            'ConvNeXtLarge': models.convnext_large
+            'ResNet18': (models.resnet18, 'ResNet'),
+            'ResNet': (models.resnet50, 'ResNet'),
+            'DenseNet': (models.densenet161, 'DenseNet'),
+            'EfficientNetB0': (models.efficientnet_b0, 'EfficientNet'),
+            'EfficientNetB2': (models.efficientnet_b2, 'EfficientNet'),
+            'EfficientNetB4': (models.efficientnet_b4, 'EfficientNet'),
+            'EfficientNetB6': (models.efficientnet_b6, 'EfficientNet'),
+            'EfficientNetV2s': (models.efficientnet_v2_s, 'EfficientNet'),
+            'EfficientNetV2m': (models.efficientnet_v2_m, 'EfficientNet'),
+            'EfficientNetV2l': (models.efficientnet_v2_l, 'EfficientNet'),
+            'ConvNeXtTiny': (models.convnext_tiny, 'ConvNeXt'),
+            'ConvNeXtSmall': (models.convnext_small, 'ConvNeXt'),
+            'ConvNeXtBase': (models.convnext_base, 'ConvNeXt'),
+            'ConvNeXtLarge': (models.convnext_large, 'ConvNeXt')
             }
 
     vit = {
-            'ViTb16': models.vit_b_16,
-            'ViTb32': models.vit_b_32,
-            'ViTl16': models.vit_l_16,
-            'ViTl32': models.vit_l_32,
-            'ViTH14': models.vit_h_14
+            'ViTb16': (models.vit_b_16, 'ViT'),
+            'ViTb32': (models.vit_b_32, 'ViT'),
+            'ViTl16': (models.vit_l_16, 'ViT'),
+            'ViTl32': (models.vit_l_32, 'ViT'),
+            'ViTH14': (models.vit_h_14, 'ViT')
             }
 
     net = {**cnn, **vit}
 
-    _classifier = {
+    # Family of each network, including MLP.
+    family = {'MLP': 'MLP', **{net_name: _family for net_name, (_, _family) in net.items()}}
+
+    # Attribute name of classifier for each family
+    classifier = {
             'ResNet': 'fc',
             'DenseNet': 'classifier',
             'EfficientNet': 'classifier',
-            'ConvNext': 'classifier',
+            'ConvNeXt': 'classifier',
             'ViT': 'heads'
             }
 
-    classifier = {
-                'ResNet18': _classifier['ResNet'],
-                'ResNet': _classifier['ResNet'],
-                'DenseNet': _classifier['DenseNet'],
-                'EfficientNetB0': _classifier['EfficientNet'],
-                'EfficientNetB2': _classifier['EfficientNet'],
-                'EfficientNetB4': _classifier['EfficientNet'],
-                'EfficientNetB6': _classifier['EfficientNet'],
-                'EfficientNetV2s': _classifier['EfficientNet'],
-                'EfficientNetV2m': _classifier['EfficientNet'],
-                'EfficientNetV2l': _classifier['EfficientNet'],
-                'ConvNeXtTiny': _classifier['ConvNext'],
-                'ConvNeXtSmall': _classifier['ConvNext'],
-                'ConvNeXtBase':  _classifier['ConvNext'],
-                'ConvNeXtLarge':  _classifier['ConvNext'],
-                'ViTb16': _classifier['ViT'],
-                'ViTb32': _classifier['ViT'],
-                'ViTl16': _classifier['ViT'],
-                'ViTl32': _classifier['ViT'],
-                'ViTH14': _classifier['ViT']
-                }
+    # First convolution for each family, which is aligned when gray scale image is input.
+    first_conv = {
+            'ResNet': lambda net: net.conv1,
+            'DenseNet': lambda net: net.features.conv0,
+            'EfficientNet': lambda net: net.features[0][0],
+            'ConvNeXt': lambda net: net.features[0][0],
+            'ViT': lambda net: net.conv_proj
+            }
+
+    # Last extractor for each family, which is used for Grad-CAM.
+    last_extractor = {
+            'ResNet': lambda extractor: extractor.layer4[-1],
+            'DenseNet': lambda extractor: extractor.features.denseblock4.denselayer24,
+            'EfficientNet': lambda extractor: extractor.features[-1],
+            'ConvNeXt': lambda extractor: extractor.features[-1][-1].block,
+            'ViT': lambda extractor: extractor.encoder.layers[-1]
+            }
 
     mlp_config = {
                 'hidden_channels': [256, 256, 256],
@@ -105,28 +204,13 @@ class BaseNet:
         Returns:
             nn.Module: network available for gray scale
         """
-        if net_name.startswith('ResNet'):
-            net.conv1.in_channels = 1
-            net.conv1.weight = nn.Parameter(net.conv1.weight.sum(dim=1).unsqueeze(1))
-
-        elif net_name.startswith('DenseNet'):
-            net.features.conv0.in_channels = 1
-            net.features.conv0.weight = nn.Parameter(net.features.conv0.weight.sum(dim=1).unsqueeze(1))
-
-        elif net_name.startswith('Efficient'):
-            net.features[0][0].in_channels = 1
-            net.features[0][0].weight = nn.Parameter(net.features[0][0].weight.sum(dim=1).unsqueeze(1))
-
-        elif net_name.startswith('ConvNeXt'):
-            net.features[0][0].in_channels = 1
-            net.features[0][0].weight = nn.Parameter(net.features[0][0].weight.sum(dim=1).unsqueeze(1))
-
-        elif net_name.startswith('ViT'):
-            net.conv_proj.in_channels = 1
-            net.conv_proj.weight = nn.Parameter(net.conv_proj.weight.sum(dim=1).unsqueeze(1))
-
-        else:
+        _family = cls.family.get(net_name)
+        if _family not in cls.first_conv:
             raise ValueError(f"No specified net: {net_name}.")
+
+        conv = cls.first_conv[_family](net)
+        conv.in_channels = 1
+        conv.weight = nn.Parameter(conv.weight.sum(dim=1).unsqueeze(1))
         return net
 
     @classmethod
@@ -153,9 +237,9 @@ class BaseNet:
         assert net_name in cls.net, f"No specified net: {net_name}."
         if net_name in cls.cnn:
             if pretrained:
-                net = cls.cnn[net_name](weights='DEFAULT')
+                net = cls.cnn[net_name][0](weights='DEFAULT')
             else:
-                net = cls.cnn[net_name]()
+                net = cls.cnn[net_name][0]()
         else:
             # When ViT
             # always use pretrained
@@ -163,6 +247,10 @@ class BaseNet:
 
         if in_channel == 1:
             net = cls.align_in_channels_1ch(net_name=net_name, net=net)
+
+        if net_name in cls.cnn:
+            # NHWC lets cuDNN select faster convolution kernels on Tensor Cores.
+            net = net.to(memory_format=torch.channels_last)
         return net
 
     @classmethod
@@ -177,7 +265,7 @@ class BaseNet:
         Returns:
             nn.Module: modified ViT
         """
-        base_vit = cls.vit[net_name]
+        base_vit = cls.vit[net_name][0]
         # pretrained_vit = base_vit(weights=cls.vit_weight[net_name])
         pretrained_vit = base_vit(weights='DEFAULT')
 
@@ -219,7 +307,7 @@ class BaseNet:
             extractor = cls.MLPNet(mlp_num_inputs=mlp_num_inputs)
         else:
             extractor = cls.set_net(net_name=net_name, in_channel=in_channel, vit_image_size=vit_image_size, pretrained=pretrained)
-            setattr(extractor, cls.classifier[net_name], cls.DUMMY)  # Replace classifier with DUMMY(=nn.Identity()).
+            setattr(extractor, cls.classifier[cls.family[net_name]], cls.DUMMY)  # Replace classifier with DUMMY(=nn.Identity()).
         return extractor
 
     @classmethod
@@ -233,71 +321,62 @@ class BaseNet:
         Returns:
             nn.Module: classifier of network
         """
-        net = cls.net[net_name]()
-        classifier = getattr(net, cls.classifier[net_name])
+        net = cls.net[net_name][0]()
+        classifier = getattr(net, cls.classifier[cls.family[net_name]])
         return classifier
 
     @classmethod
-    def construct_multi_classifier(cls, net_name: str = None, num_outputs_for_label: Dict[str, int] = None) -> nn.ModuleDict:
+    def construct_multi_classifier(cls, net_name: str = None, num_outputs_for_label: Dict[str, int] = None) -> MultiClassifier:
         """
         Construct classifier for multi-label.
+        Classifiers of all labels are fused into a single nn.Linear, and the layers which
+        the original classifier applies before nn.Linear are shared among labels.
 
         Args:
             net_name (str): network name
             num_outputs_for_label (Dict[str, int]): number of outputs for each label
 
         Returns:
-            nn.ModuleDict: classifier for multi-label
+            MultiClassifier: classifier for multi-label
         """
-        classifiers = dict()
-        if net_name == 'MLP':
+        pre_module = None
+        _family = cls.family.get(net_name)
+        if _family == 'MLP':
             in_features = cls.mlp_config['hidden_channels'][-1]
-            for label_name, num_outputs in num_outputs_for_label.items():
-                classifiers[label_name] = nn.Linear(in_features, num_outputs)
 
-        elif net_name.startswith('ResNet') or net_name.startswith('DenseNet'):
+        elif (_family == 'ResNet') or (_family == 'DenseNet'):
             base_classifier = cls.get_classifier(net_name)
             in_features = base_classifier.in_features
-            for label_name, num_outputs in num_outputs_for_label.items():
-                classifiers[label_name] = nn.Linear(in_features, num_outputs)
 
-        elif net_name.startswith('EfficientNet'):
+        elif _family == 'EfficientNet':
             base_classifier = cls.get_classifier(net_name)
             dropout = base_classifier[0].p
             in_features = base_classifier[1].in_features
-            for label_name, num_outputs in num_outputs_for_label.items():
-                classifiers[label_name] = nn.Sequential(
-                                                        nn.Dropout(p=dropout, inplace=False),
-                                                        nn.Linear(in_features, num_outputs)
-                                                    )
+            pre_module = nn.Dropout(p=dropout, inplace=False)
 
-        elif net_name.startswith('ConvNeXt'):
+        elif _family == 'ConvNeXt':
             base_classifier = cls.get_classifier(net_name)
             layer_norm = base_classifier[0]
             flatten = base_classifier[1]
             in_features = base_classifier[2].in_features
-            for label_name, num_outputs in num_outputs_for_label.items():
-                # Shape is changed before nn.Linear.
-                classifiers[label_name] = nn.Sequential(
-                                                        layer_norm,
-                                                        flatten,
-                                                        nn.Linear(in_features, num_outputs)
-                                                    )
+            # Shape is changed before nn.Linear.
+            pre_module = nn.Sequential(
+                                    layer_norm,
+                                    flatten
+                                    )
 
-        elif net_name.startswith('ViT'):
+        elif _family == 'ViT':
             base_classifier = cls.get_classifier(net_name)
             in_features = base_classifier.head.in_features
-            for label_name, num_outputs in num_outputs_for_label.items():
-                classifiers[label_name] = nn.Sequential(
-                                                OrderedDict([
-                                                        ('head', nn.Linear(in_features, num_outputs))
-                                                        ])
-                                                )
 
         else:
             raise ValueError(f"No specified net: {net_name}.")
 
-        multi_classifier = nn.ModuleDict(classifiers)
+        multi_classifier = MultiClassifier(
+                                        in_features=in_features,
+                                        num_outputs_for_label=num_outputs_for_label,
+                                        pre_module=pre_module
+                                        )
         return multi_classifier
 
     @classmethod
@@ -318,22 +397,23 @@ class BaseNet:
         classifier.[2].in_features
         classifier.head.in_features
         """
-        if net_name == 'MLP':
+        _family = cls.family.get(net_name)
+        if _family == 'MLP':
             in_features = cls.mlp_config['hidden_channels'][-1]
 
-        elif net_name.startswith('ResNet') or net_name.startswith('DenseNet'):
+        elif (_family == 'ResNet') or (_family == 'DenseNet'):
             base_classifier = cls.get_classifier(net_name)
             in_features = base_classifier.in_features
 
-        elif net_name.startswith('EfficientNet'):
+        elif _family == 'EfficientNet':
             base_classifier = cls.get_classifier(net_name)
             in_features = base_classifier[1].in_features
 
-        elif net_name.startswith('ConvNeXt'):
+        elif _family == 'ConvNeXt':
             base_classifier = cls.get_classifier(net_name)
             in_features = base_classifier[2].in_features
 
-        elif net_name.startswith('ViT'):
+        elif _family == 'ViT':
             base_classifier = cls.get_classifier(net_name)
             in_features = base_classifier.head.in_features
 
@@ -363,7 +443,7 @@ class BaseNet:
             nn.Module: layers such that they align the dimension of the output from the extractor like the original ConvNeXt.
         """
         aux_module = cls.DUMMY
-        if net_name.startswith('ConvNeXt'):
+        if cls.family.get(net_name) == 'ConvNeXt':
             base_classifier = cls.get_classifier(net_name)
             layer_norm = base_classifier[0]
             flatten = base_classifier[1]
@@ -392,18 +472,11 @@ class BaseNet:
 
         _extractor = net.extractor_net
 
-        if net_name.startswith('ResNet'):
-            last_extractor = _extractor.layer4[-1]
-        elif net_name.startswith('DenseNet'):
-            last_extractor = _extractor.features.denseblock4.denselayer24
-        elif net_name.startswith('EfficientNet'):
-            last_extractor = _extractor.features[-1]
-        elif net_name.startswith('ConvNeXt'):
-            last_extractor = _extractor.features[-1][-1].block
-        elif net_name.startswith('ViT'):
-            last_extractor = _extractor.encoder.layers[-1]
-        else:
+        _family = cls.family.get(net_name)
+        if _family not in cls.last_extractor:
             raise ValueError(f"Cannot get last extractor of net: {net_name}.")
+
+        last_extractor = cls.last_extractor[_family](_extractor)
         return last_extractor
 
 
@@ -411,19 +484,17 @@ class MultiMixin:
     """
     Class to define auxiliary function to handle multi-label.
     """
-    def multi_forward(self, out_features: int) -> Dict[str, float]:
+    def multi_forward(self, out_features: torch.Tensor) -> Dict[str, torch.Tensor]:
         """
         Forward out_features to classifier for each label.
 
         Args:
-            out_features (int): output from extractor
+            out_features (torch.Tensor): output from extractor
 
         Returns:
-            Dict[str, float]: output of classifier of each label
+            Dict[str, torch.Tensor]: output of classifier of each label
         """
-        output = dict()
-        for label_name, classifier in self.multi_classifier.items():
-            output[label_name] = classifier(out_features)
+        output = self.multi_classifier(out_features)
         return output
 
 
@@ -563,6 +634,48 @@ class MultiNetFusion(MultiWidget):
         return output
 
 
+def compile_net(network: nn.Module) -> nn.Module:
+    """
+    Compile network with torch.compile.
+    Network is compiled in place, so that the keys of its state_dict do not change
+    and weights are saved and loaded as well as without compiling.
+
+    Args:
+        network (nn.Module): network
+
+    Returns:
+        nn.Module: compiled network, or network as it is if torch does not support compiling in place
+    """
+    if not hasattr(network, 'compile'):
+        logger.warning(f"torch {torch.__version__} cannot compile network in place. Network is not compiled.")
+        return network
+
+    # Keep compiled kernels across runs to skip the warm-up of compiling them again.
+    os.environ.setdefault('TORCHINDUCTOR_CACHE_DIR', os.path.abspath('./results/.torchinductor_cache'))
+
+    # 'reduce-overhead' captures CUDA graphs to cut the launch overhead of small kernels.
+    network.compile(mode='reduce-overhead', fullgraph=False)
+    return network
+
+
+def script_net(network: nn.Module) -> torch.jit.ScriptModule:
+    """
+    Script network with TorchScript and optimize it for inference.
+    Parameters are frozen, dropout is removed, and constants are folded,
+    therefore weight should be loaded before scripting.
+
+    Args:
+        network (nn.Module): network
+
+    Returns:
+        torch.jit.ScriptModule: network optimized for inference
+    """
+    # torch.jit.trace cannot be used because network returns dictionary keyed by label name.
+    scripted = torch.jit.script(network.eval())
+    scripted = torch.jit.optimize_for_inference(scripted)
+    return scripted
+
+
 def create_net(
             mlp: Optional[str] = None,
             net: Optional[str] = None,
@@ -570,7 +683,8 @@ def create_net(
             mlp_num_inputs: int = None,
             in_channel: int = None,
             vit_image_size: int = None,
-            pretrained: bool = None
+            pretrained: bool = None,
+            use_compile: bool = None
             ) -> nn.Module:
     """
     Create network.
@@ -583,6 +697,7 @@ def create_net(
         in_channel (int): number of image channel, ie gray scale(=1) or color image(=3).
         vit_image_size (int): image size to be input to ViT.
         pretrained (bool): True when use pretrained CNN or ViT, otherwise False.
+        use_compile (bool): True when network is compiled with torch.compile, otherwise False.
 
     Returns:
         nn.Module: network
@@ -621,4 +736,6 @@ def create_net(
     else:
         raise ValueError(f"Invalid model type: mlp={mlp}, net={net}.")
 
+    if use_compile:
+        multi_net = compile_net(multi_net)
     return multi_net
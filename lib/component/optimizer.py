@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import inspect
 import torch.optim as optim
 import torch.nn as nn
 
@@ -27,8 +28,18 @@ def set_optimizer(optimizer_name: str, network: nn.Module, lr: float) -> optim:
 
     _optim = optimizers[optimizer_name]
 
-    if lr is None:
-        optimizer = _optim(network.parameters())
-    else:
-        optimizer = _optim(network.parameters(), lr=lr)
+    # Update all parameters in a single kernel if fused implementation is available on GPU,
+    # otherwise in grouped kernels for each operation.
+    _kwargs = {}
+    _optim_args = inspect.signature(_optim).parameters
+    _on_cuda = all(param.is_cuda for param in network.parameters())
+    if _on_cuda and ('fused' in _optim_args):
+        _kwargs['fused'] = True
+    elif 'foreach' in _optim_args:
+        _kwargs['foreach'] = True
+
+    if lr is not None:
+        _kwargs['lr'] = lr
+
+    optimizer = _optim(network.parameters(), **_kwargs)
     return optimizer
@@ -1,12 +1,15 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import os
 import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision.transforms as transforms
 from torch.utils.data.dataset import Dataset
-from torch.utils.data.dataloader import DataLoader
+from torch.utils.data.dataloader import DataLoader, default_collate
 from torch.utils.data.sampler import WeightedRandomSampler
+from torch.utils.data.distributed import DistributedSampler
 from PIL import Image
 from sklearn.preprocessing import MinMaxScaler
 import pickle
@@ -358,6 +361,30 @@ def _make_sampler(split_data: LoadDataSet) -> WeightedRandomSampler:
     return sampler
 
 
+def _collate(batch: List[Dict]) -> Dict:
+    """
+    Collate batch, and stack labels of the same dtype into a tensor of (batch, number of labels)
+    so that they are pinned and copied to device at once.
+
+    Args:
+        batch (List[Dict]): list of data
+
+    Returns:
+        Dict: batch data, which has stacked labels with their names as 'stacked_labels'
+    """
+    collated = default_collate(batch)
+
+    label_names_for_dtype = dict()
+    for label_name, label in collated['labels'].items():
+        label_names_for_dtype.setdefault(label.dtype, []).append(label_name)
+
+    collated['stacked_labels'] = [
+                                (label_names, torch.stack([collated['labels'][label_name] for label_name in label_names], dim=1))
+                                for label_names in label_names_for_dtype.values()
+                                ]
+    return collated
+
+
 def create_dataloader(
                     params,
                     split: str = None
@@ -390,11 +417,28 @@ def create_dataloader(
         # When params.sampler == 'no'
         sampler = None
 
+    # When trained with DistributedDataParallel, each process loads its own part of split.
+    if params.isTrain and dist.is_available() and dist.is_initialized():
+        assert (sampler is None), 'Cannot use sampler with DistributedDataParallel.'
+        sampler = DistributedSampler(split_data, shuffle=shuffle)
+        shuffle = False
+
+    # Pinned memory enables asynchronous copy to GPU.
+    pin_memory = (params.gpu_ids != [])
+
+    # Load batches in background processes, sharing CPU cores among processes of GPUs.
+    # More than 4 workers contend with the main process rather than speed up loading.
+    num_workers = max(1, min(4, (os.cpu_count() or 2) // max(1, len(params.gpu_ids))))
+
     split_loader = DataLoader(
                             dataset=split_data,
                             batch_size=batch_size,
                             shuffle=shuffle,
-                            num_workers=0,
-                            sampler=sampler
+                            num_workers=num_workers,
+                            sampler=sampler,
+                            collate_fn=_collate,
+                            pin_memory=pin_memory,
+                            persistent_workers=True,
+                            prefetch_factor=2
                             )
     return split_loader
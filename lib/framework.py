@@ -2,11 +2,15 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
-import copy
+import os
+import io
+import inspect
 from abc import ABC, abstractmethod
 import torch
 import torch.nn as nn
-from .component import create_net
+import torch.distributed as dist
+from .component import create_net, script_net
+from .component.net import BaseNet
 from .logger import BaseLogger
 from lib import ParamSet
 from typing import List, Dict, Tuple, Union
@@ -33,6 +37,11 @@ class BaseModel(ABC):
         self.params = params
         self.device = self.params.device
 
+        if self.params.amp:
+            # Allow TF32 on matmul and convolution, which runs on Tensor Cores of Ampere or later GPUs.
+            torch.backends.cuda.matmul.allow_tf32 = True
+            torch.backends.cudnn.allow_tf32 = True
+
         self.network = create_net(
                                 mlp=self.params.mlp,
                                 net=self.params.net,
@@ -40,14 +49,50 @@ class BaseModel(ABC):
                                 mlp_num_inputs=self.params.mlp_num_inputs,
                                 in_channel=self.params.in_channel,
                                 vit_image_size=self.params.vit_image_size,
-                                pretrained=self.params.pretrained
+                                pretrained=self.params.pretrained,
+                                use_compile=self.params.compile
                                 )
         self.network.to(self.device)
+        # Network without DataParallel or DistributedDataParallel, whose weight is stored.
+        self.core_network = self.network
+
+        # CNN is in channels_last, so is image input to it. ViT is kept in the default layout.
+        if (self.params.net is not None) and (BaseNet.family[self.params.net] != 'ViT'):
+            self.image_memory_format = torch.channels_last
+        else:
+            self.image_memory_format = torch.contiguous_format
 
         # variables to keep temporary best_weight and best_epoch
         self.acting_best_weight = None
         self.acting_best_epoch = None
 
+    def autocast(self) -> torch.autocast:
+        """
+        Return context manager to run forward in mixed precision when amp is specified.
+        bfloat16 is used if GPU supports it, otherwise float16.
+        On CPU, mixed precision is disabled.
+
+        Returns:
+            torch.autocast: context manager of autocast
+        """
+        if (not self.params.amp) or (self.device.type != 'cuda'):
+            return torch.autocast(device_type='cpu', enabled=False)
+
+        _dtype = torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        return torch.autocast(device_type='cuda', dtype=_dtype)
+
+    def grad_scaler(self) -> torch.cuda.amp.GradScaler:
+        """
+        Return gradient scaler to prevent gradients in float16 from underflowing.
+        Scaling is enabled only when autocast runs in float16,
+        because bfloat16 has as wide a range as float32.
+
+        Returns:
+            torch.cuda.amp.GradScaler: gradient scaler
+        """
+        _enabled = self.params.amp and (self.device.type == 'cuda') and (not torch.cuda.is_bf16_supported())
+        return torch.cuda.amp.GradScaler(enabled=_enabled)
+
     def train(self) -> None:
         """
         Make network training mode.
@@ -79,12 +124,11 @@ class BaseModel(ABC):
         """
         self.acting_best_epoch = at_epoch
 
-        _network = copy.deepcopy(self.network)
-        if hasattr(_network, 'module'):
-            # When DataParallel used, move weight to CPU.
-            self.acting_best_weight = copy.deepcopy(_network.module.to(torch.device('cpu')).state_dict())
-        else:
-            self.acting_best_weight = copy.deepcopy(_network.state_dict())
+        # Keep weight serialized, so that it is snapshotted at this epoch and written to file as it is.
+        _weight = {param_name: param.detach().to('cpu') for param_name, param in self.core_network.state_dict().items()}
+        _buffer = io.BytesIO()
+        torch.save(_weight, _buffer, _use_new_zipfile_serialization=True)
+        self.acting_best_weight = _buffer.getvalue()
 
     def save_weight(self, save_datetime_dir: str, as_best: bool = None) -> None:
         """
@@ -107,10 +151,10 @@ class BaseModel(ABC):
                 # Check if best weight already saved. If exists, rename with '_best'
                 save_path.rename(save_path_as_best)
             else:
-                torch.save(self.acting_best_weight, save_path_as_best)
+                save_path_as_best.write_bytes(self.acting_best_weight)
         else:
             save_name = 'weight_epoch-' + str(self.acting_best_epoch).zfill(3) + '.pt'
-            torch.save(self.acting_best_weight, save_path)
+            save_path.write_bytes(self.acting_best_weight)
 
     def load_weight(self, weight_path: Path) -> None:
         """
@@ -120,7 +164,12 @@ class BaseModel(ABC):
             weight_path (Path): path to weight
         """
         logger.info(f"Load weight: {weight_path}.\n")
-        weight = torch.load(weight_path)
+        # Weight is read onto CPU and copied into parameters already on the device.
+        # When torch supports it, the file is memory-mapped instead of being read whole.
+        _load_kwargs = {'map_location': 'cpu', 'weights_only': True}
+        if 'mmap' in inspect.signature(torch.load).parameters:
+            _load_kwargs['mmap'] = True
+        weight = torch.load(weight_path, **_load_kwargs)
         self.network.load_state_dict(weight)
 
 
@@ -128,13 +177,68 @@ class ModelMixin:
     def to_gpu(self, gpu_ids: List[int]) -> None:
         """
         Make model compute on the GPU.
+        When a single GPU is used, network is not wrapped since it is already on the device.
+        When multiple GPUs are used in training and the process is launched by torchrun,
+        network is wrapped with DistributedDataParallel, one process per GPU.
+        Otherwise, including test, network is wrapped with DataParallel.
 
         Args:
             gpu_ids (List[int]): GPU ids
         """
         if gpu_ids != []:
             assert torch.cuda.is_available(), 'No available GPU on this machine.'
-            self.network = nn.DataParallel(self.network, device_ids=gpu_ids)
+
+            if len(gpu_ids) == 1:
+                # No need of wrapper, which only adds scatter and gather to the same device.
+                pass
+            elif self.params.isTrain and ('LOCAL_RANK' in os.environ):
+                if not dist.is_initialized():
+                    dist.init_process_group(backend='nccl')
+                torch.cuda.set_device(self.device)
+                if any(isinstance(module, nn.modules.batchnorm._BatchNorm) for module in self.network.modules()):
+                    # Compute statistics of BatchNorm over batches of all processes.
+                    self.network = nn.SyncBatchNorm.convert_sync_batchnorm(self.network)
+                self.network = nn.parallel.DistributedDataParallel(
+                                                                self.network,
+                                                                device_ids=[self.device.index],
+                                                                output_device=self.device.index,
+                                                                find_unused_parameters=False
+                                                                )
+            else:
+                self.network = nn.DataParallel(self.network, device_ids=gpu_ids)
+
+        if isinstance(self.network, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+            self.core_network = self.network.module
+        else:
+            self.core_network = self.network
+
+    def multi_label_to_device(self, data: Dict) -> Dict[str, torch.Tensor]:
+        """
+        Pass labels to device.
+        Labels of the same dtype, which are stacked and pinned by the dataloader,
+        are copied at once, then split into each label on the device.
+
+        Args:
+            data (Dict): dictionary of data
+
+        Returns:
+            Dict[str, torch.Tensor]: labels on device
+        """
+        _multi_label = dict()
+        for label_names, stacked_label in data['stacked_labels']:
+            stacked_label = stacked_label.to(self.device, non_blocking=True)
+            _multi_label.update(zip(label_names, stacked_label.unbind(dim=1)))
+
+        # Keep the order of labels.
+        return {label_name: _multi_label[label_name] for label_name in data['labels'].keys()}
+
+    def script_network(self) -> None:
+        """
+        Script network for inference.
+        This method is used at test after loading weight and before to_gpu().
+        """
+        self.network = script_net(self.network)
+        self.core_network = self.network
 
     def init_network(self) -> None:
         """
@@ -148,9 +252,11 @@ class ModelMixin:
                                 mlp_num_inputs=self.params.mlp_num_inputs,
                                 in_channel=self.params.in_channel,
                                 vit_image_size=self.params.vit_image_size,
-                                pretrained=self.params.pretrained
+                                pretrained=self.params.pretrained,
+                                use_compile=self.params.compile
                                 )
         self.network.to(self.device)
+        self.core_network = self.network
 
 class ModelWidget(BaseModel, ModelMixin):
     """
@@ -194,8 +300,8 @@ class MLPModel(ModelWidget):
         eg.
         ([inputs], [labels]), or ([inputs], [labels, periods, network]) when deepsurv
         """
-        in_data = {'inputs': data['inputs'].to(self.device)}
-        labels = {'labels': {label_name: label.to(self.device) for label_name, label in data['labels'].items()}}
+        in_data = {'inputs': data['inputs'].to(self.device, non_blocking=True)}
+        labels = {'labels': self.multi_label_to_device(data)}
 
         if not any(data['periods']):
             return in_data, labels
@@ -203,7 +309,7 @@ class MLPModel(ModelWidget):
         # When deepsurv
         labels = {
                   **labels,
-                  **{'periods': data['periods'].to(self.device), 'network': self.network.to(self.device)}
+                  **{'periods': data['periods'].to(self.device, non_blocking=True), 'network': self.network.to(self.device)}
                 }
         return in_data, labels
 
@@ -255,8 +361,8 @@ class CVModel(ModelWidget):
         eg.
         ([image], [labels]), or ([image], [labels, periods, network]) when deepsurv
         """
-        in_data = {'image': data['image'].to(self.device)}
-        labels = {'labels': {label_name: label.to(self.device) for label_name, label in data['labels'].items()}}
+        in_data = {'image': data['image'].to(self.device, memory_format=self.image_memory_format, non_blocking=True)}
+        labels = {'labels': self.multi_label_to_device(data)}
 
         if not any(data['periods']):
             return in_data, labels
@@ -264,7 +370,7 @@ class CVModel(ModelWidget):
         # When deepsurv
         labels = {
                   **labels,
-                  **{'periods': data['periods'].to(self.device), 'network': self.network.to(self.device)}
+                  **{'periods': data['periods'].to(self.device, non_blocking=True), 'network': self.network.to(self.device)}
                 }
         return in_data, labels
 
@@ -318,10 +424,10 @@ class FusionModel(ModelWidget):
         ([inputs, image], [labels]), or ([inputs, image], [labels, periods, network]) when deepsurv
         """
         in_data = {
-                'inputs': data['inputs'].to(self.device),
-                'image': data['image'].to(self.device)
+                'inputs': data['inputs'].to(self.device, non_blocking=True),
+                'image': data['image'].to(self.device, memory_format=self.image_memory_format, non_blocking=True)
                 }
-        labels = {'labels': {label_name: label.to(self.device) for label_name, label in data['labels'].items()}}
+        labels = {'labels': self.multi_label_to_device(data)}
 
         if not any(data['periods']):
             return in_data, labels
@@ -329,7 +435,7 @@ class FusionModel(ModelWidget):
         # When deepsurv
         labels = {
                   **labels,
-                  **{'periods': data['periods'].to(self.device), 'network': self.network.to(self.device)}
+                  **{'periods': data['periods'].to(self.device, non_blocking=True), 'network': self.network.to(self.device)}
                 }
         return in_data, labels
 
@@ -2,84 +2,118 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import os
+import re
+import functools
 from distutils.util import strtobool
 from pathlib import Path
 import pandas as pd
 import json
 import torch
 from .logger import BaseLogger
-from typing import List, Dict, Tuple, Union
+from typing import List, Dict, Tuple, Union, Iterator
 
 
 logger = BaseLogger.get_logger(__name__)
 
+# Pattern of GPU ids concatenated with '-', eg. '0-1-2', and of each GPU id in it
+GPU_IDS_PATTERN = re.compile(r'\d+(-\d+)*')
+GPU_ID_PATTERN = re.compile(r'\d+')
+
 
 class Options:
     """
     Class for options.
     """
-    def __init__(self,  datetime: str = None, isTrain: bool = None) -> None:
+    def __init__(self, datetime: str = None, isTrain: bool = None, argv: List[str] = None) -> None:
         """
-            Args:
-            datetime (str, optional): date time    Args:
+        Args:
+            datetime (str, optional): date time
             isTrain (bool, optional): Variable indicating whether training or not. Defaults to None.
+            argv (List[str], optional): arguments to be parsed. If None, sys.argv is parsed. Defaults to None.
+        """
+        assert isinstance(isTrain, bool), 'isTrain should be bool.'
+
+        self.parser = self._build_parser(isTrain)
+        self.args = self.parser.parse_args(argv)
+
+        if datetime is not None:
+            self.args.datetime = datetime
+
+        self.args.isTrain = isTrain
+
+    @staticmethod
+    @functools.lru_cache(maxsize=2)
+    def _build_parser(isTrain: bool) -> argparse.ArgumentParser:
         """
-        self.parser = argparse.ArgumentParser(description='Options for training or test')
+        Build parser for training or test.
+        Parser is built once for each of training and test, and reused.
+
+        Args:
+            isTrain (bool): Variable indicating whether training or not
+
+        Returns:
+            argparse.ArgumentParser: parser
+        """
+        parser = argparse.ArgumentParser(description='Options for training or test')
 
         # CSV
-        self.parser.add_argument('--csvpath', type=str, required=True, help='path to csv for training or test')
+        parser.add_argument('--csvpath', type=str, required=True, help='path to csv for training or test')
 
         # GPU Ids
-        self.parser.add_argument('--gpu_ids', type=str, default='cpu', help='gpu ids: e.g. 0, 0-1-2, 0-2. Use cpu for CPU (Default: cpu)')
+        parser.add_argument('--gpu_ids', type=str, default='cpu', help='gpu ids: e.g. 0, 0-1-2, 0-2. Use cpu for CPU (Default: cpu)')
+
+        # Compile
+        parser.add_argument('--compile', type=strtobool, default=False, help='compile network with torch.compile (Default: False)')
+
+        # Mixed precision
+        parser.add_argument('--amp', type=strtobool, default=False, help='run network in mixed precision with autocast and TF32 on GPU (Default: False)')
 
         if isTrain:
             # Task
-            self.parser.add_argument('--task', type=str, required=True, choices=['classification', 'regression', 'deepsurv'], help='Task')
+            parser.add_argument('--task', type=str, required=True, choices=['classification', 'regression', 'deepsurv'], help='Task')
 
             # Model
-            self.parser.add_argument('--model',      type=str, required=True, help='model: MLP, CNN, ViT, or MLP+(CNN or ViT)')
-            self.parser.add_argument('--pretrained', type=strtobool, default=False, help='For use of pretrained model(CNN or ViT)')
+            parser.add_argument('--model',      type=str, required=True, help='model: MLP, CNN, ViT, or MLP+(CNN or ViT)')
+            parser.add_argument('--pretrained', type=strtobool, default=False, help='For use of pretrained model(CNN or ViT)')
 
             # Training and Internal validation
-            self.parser.add_argument('--criterion', type=str,   required=True, choices=['CEL', 'MSE', 'RMSE', 'MAE', 'NLL'], help='criterion')
-            self.parser.add_argument('--optimizer', type=str,   default='Adam', choices=['SGD', 'Adadelta', 'RMSprop', 'Adam', 'RAdam'], help='optimizer')
-            self.parser.add_argument('--lr',        type=float,                metavar='N', help='learning rate')
-            self.parser.add_argument('--epochs',    type=int,   default=10,    metavar='N', help='number of epochs (Default: 10)')
+            parser.add_argument('--criterion', type=str,   required=True, choices=['CEL', 'MSE', 'RMSE', 'MAE', 'NLL'], help='criterion')
+            parser.add_argument('--optimizer', type=str,   default='Adam', choices=['SGD', 'Adadelta', 'RMSprop', 'Adam', 'RAdam'], help='optimizer')
+            parser.add_argument('--lr',        type=float,                metavar='N', help='learning rate')
+            parser.add_argument('--epochs',    type=int,   default=10,    metavar='N', help='number of epochs (Default: 10)')
 
             # Batch size
-            self.parser.add_argument('--batch_size', type=int,  required=True, metavar='N', help='batch size in training')
+            parser.add_argument('--batch_size', type=int,  required=True, metavar='N', help='batch size in training')
 
             # Preprocess for image
-            self.parser.add_argument('--augmentation',       type=str,  default='no', choices=['xrayaug', 'trivialaugwide', 'randaug', 'no'], help='kind of augmentation')
-            self.parser.add_argument('--normalize_image',    type=str,                choices=['yes', 'no'], default='yes', help='image normalization: yes, no (Default: yes)')
+            parser.add_argument('--augmentation',       type=str,  default='no', choices=['xrayaug', 'trivialaugwide', 'randaug', 'no'], help='kind of augmentation')
+            parser.add_argument('--normalize_image',    type=str,                choices=['yes', 'no'], default='yes', help='image normalization: yes, no (Default: yes)')
 
             # Sampler
-            self.parser.add_argument('--sampler',            type=str,  default='no',  choices=['yes', 'no'], help='sample data in training or not, yes or no')
+            parser.add_argument('--sampler',            type=str,  default='no',  choices=['yes', 'no'], help='sample data in training or not, yes or no')
 
             # Input channel
-            self.parser.add_argument('--in_channel',         type=int,  required=True, choices=[1, 3], help='channel of input image')
-            self.parser.add_argument('--vit_image_size',     type=int,  default=0,                     help='input image size for ViT. Set 0 if not used ViT (Default: 0)')
+            parser.add_argument('--in_channel',         type=int,  required=True, choices=[1, 3], help='channel of input image')
+            parser.add_argument('--vit_image_size',     type=int,  default=0,                     help='input image size for ViT. Set 0 if not used ViT (Default: 0)')
 
             # Weight saving strategy
-            self.parser.add_argument('--save_weight_policy', type=str,  choices=['best', 'each'], default='best', help='Save weight policy: best, or each(ie. save each time loss decreases when multi-label output) (Default: best)')
+            parser.add_argument('--save_weight_policy', type=str,  choices=['best', 'each'], default='best', help='Save weight policy: best, or each(ie. save each time loss decreases when multi-label output) (Default: best)')
 
         else:
             # Directory of weight at training
-            self.parser.add_argument('--weight_dir',         type=str,  default=None, help='directory of weight to be used when test. If None, the latest one is selected')
+            parser.add_argument('--weight_dir',         type=str,  default=None, help='directory of weight to be used when test. If None, the latest one is selected')
 
             # Test bash size
-            self.parser.add_argument('--test_batch_size',    type=int,  default=1, metavar='N', help='batch size for test (Default: 1)')
+            parser.add_argument('--test_batch_size',    type=int,  default=1, metavar='N', help='batch size for test (Default: 1)')
 
             # Splits for test
-            self.parser.add_argument('--test_splits',        type=str, default='train-val-test', help='splits for test: e.g. test, val-test, train-val-test. (Default: train-val-test)')
+            parser.add_argument('--test_splits',        type=str, default='train-val-test', help='splits for test: e.g. test, val-test, train-val-test. (Default: train-val-test)')
 
-        self.args = self.parser.parse_args()
+            # TorchScript
+            parser.add_argument('--scripted',           type=strtobool, default=False, help='script network with TorchScript for inference (Default: False)')
 
-        if datetime is not None:
-            self.args.datetime = datetime
-
-        assert isinstance(isTrain, bool), 'isTrain should be bool.'
-        self.args.isTrain = isTrain
+        return parser
 
     def get_args(self) -> argparse.Namespace:
         """
@@ -220,18 +254,68 @@ def _parse_gpu_ids(gpu_ids: str) -> List[int]:
     Returns:
         List[int]: list of GPU ids
     """
-    if (gpu_ids == 'cpu') or (gpu_ids == 'cpu\r'):
-        str_ids = []
-    else:
-        str_ids = gpu_ids.split('-')
-    _gpu_ids = []
-    for str_id in str_ids:
-        id = int(str_id)
-        if id >= 0:
-            _gpu_ids.append(id)
+    # Strip '\r' left when options are written in a shell script with CRLF.
+    gpu_ids = gpu_ids.strip()
+    if (gpu_ids == 'cpu') or (gpu_ids == '-1'):
+        return []
+    if GPU_IDS_PATTERN.fullmatch(gpu_ids) is None:
+        raise ValueError(f"Invalid gpu_ids: {gpu_ids}.")
+    _gpu_ids = [int(str_id) for str_id in GPU_ID_PATTERN.findall(gpu_ids)]
     return _gpu_ids
 
 
+def _get_device(gpu_ids: List[int]) -> torch.device:
+    """
+    Return device on which the current process computes.
+    When launched by torchrun, each process uses the GPU of its local rank,
+    otherwise the first GPU is used as the primary GPU.
+
+    Args:
+        gpu_ids (List[int]): list of GPU ids
+
+    Returns:
+        torch.device: device
+    """
+    if gpu_ids == []:
+        return torch.device('cpu')
+
+    local_rank = int(os.environ.get('LOCAL_RANK', 0))
+    assert (local_rank < len(gpu_ids)), f"No GPU for local rank {local_rank}: gpu_ids={gpu_ids}."
+    return torch.device(f"cuda:{gpu_ids[local_rank]}")
+
+
+def _find_weight_dirs(root: str) -> Iterator[Tuple[str, float]]:
+    """
+    Yield directories of weight made at training and their modification time.
+    Directories are walked by scandir, which stats each entry at most once.
+
+    Args:
+        root (str): directory of results
+
+    Yields:
+        Tuple[str, float]: path to directory of weight and its modification time
+        eg. ('results/<project>/trials/2022-09-30-15-56-60/weights', 1664521020.0)
+    """
+    if not os.path.isdir(root):
+        return
+
+    with os.scandir(root) as project_entries:
+        for project_entry in project_entries:
+            trials_dir = os.path.join(project_entry.path, 'trials')
+            if not (project_entry.is_dir() and os.path.isdir(trials_dir)):
+                continue
+
+            with os.scandir(trials_dir) as trial_entries:
+                for trial_entry in trial_entries:
+                    if not trial_entry.is_dir():
+                        continue
+                    weight_dir = os.path.join(trial_entry.path, 'weights')
+                    try:
+                        yield weight_dir, os.stat(weight_dir).st_mtime
+                    except FileNotFoundError:
+                        pass
+
+
 def _get_latest_weight_dir() -> str:
     """
     Return the latest path to directory of weight made at training.
@@ -240,10 +324,10 @@ def _get_latest_weight_dir() -> str:
         str: path to directory of the latest weight
         eg. 'results/<project>/trials/2022-09-30-15-56-60/weights'
     """
-    _weight_dirs = list(Path('results').glob('*/trials/*/weights'))
+    _weight_dirs = list(_find_weight_dirs('results'))
     assert (_weight_dirs != []), 'No directory of weight.'
-    weight_dir = max(_weight_dirs, key=lambda weight_dir: weight_dir.stat().st_mtime)
-    return str(weight_dir)
+    weight_dir, _ = max(_weight_dirs, key=lambda weight_dir: weight_dir[1])
+    return weight_dir
 
 
 def _collect_weight_paths(weight_dir: str) -> List[str]:
@@ -256,10 +340,12 @@ def _collect_weight_paths(weight_dir: str) -> List[str]:
     Returns:
         List[str]: list of weight paths
     """
-    _weight_paths = list(Path(weight_dir).glob('*.pt'))
-    assert _weight_paths != [], f"No weight in {weight_dir}."
-    _weight_paths.sort(key=lambda path: path.stat().st_mtime)
-    _weight_paths = [str(weight_path) for weight_path in _weight_paths]
+    # DirEntry of scandir stats each weight relative to the directory already opened.
+    with os.scandir(weight_dir) as entries:
+        _weight_entries = [(entry.path, entry.stat().st_mtime) for entry in entries if entry.name.endswith('.pt')]
+    assert _weight_entries != [], f"No weight in {weight_dir}."
+    _weight_entries.sort(key=lambda weight_entry: weight_entry[1])
+    _weight_paths = [weight_path for weight_path, _ in _weight_entries]
     return _weight_paths
 
 
@@ -296,13 +382,15 @@ class ParamTable:
                 'project': [sa, trp, tsp],
                 'csvpath': [sa, trp, tsp],
                 'task': [dl, tsc, sa, lo, trp, tsp],
-                'isTrain': [dl, trp, tsp],
+                'isTrain': [mo, dl, trp, tsp],
 
                 'model': [sa, lo, trp, tsp],
                 'vit_image_size': [mo, sa, lo, trp, tsp],
                 'pretrained': [mo, sa, trp],
                 'mlp': [mo, dl],
                 'net': [mo, dl],
+                'compile': [mo, trp, tsp],
+                'amp': [mo, trp, tsp],
 
                 'weight_dir': [tsc, tsp],
                 'weight_paths': [tsc],
@@ -315,6 +403,7 @@ class ParamTable:
                 'batch_size': [dl, sa, trp],
                 'test_batch_size': [dl, tsp],
                 'test_splits': [tsc, tsp],
+                'scripted': [tsc, tsp],
 
                 'in_channel': [mo, dl, sa, lo, trp, tsp],
                 'normalize_image': [dl, sa, lo, trp, tsp],
@@ -332,28 +421,25 @@ class ParamTable:
                 'scaler_path': [dl, tsp],
                 'save_datetime_dir': [trc, tsc, trp, tsp],
 
-                'gpu_ids': [trc, tsc, sa, trp, tsp],
+                'gpu_ids': [dl, trc, tsc, sa, trp, tsp],
                 'device': [mo, trc, tsc],
                 'dataset_info': [trc, sa, trp, tsp]
                 }
 
         self.table = self._make_table()
 
-    def _make_table(self) -> pd.DataFrame:
+    def _make_table(self) -> Dict[str, List[str]]:
         """
         Make table to dispatch parameters by group.
 
         Returns:
-            pd.DataFrame: table which shows that which group each parameter belongs to.
+            Dict[str, List[str]]: table which shows parameters each group has.
         """
-        df_table = pd.DataFrame([], index=self.dispatch.keys(), columns=self.groups.values()).fillna('no')
+        table = {grp: [] for grp in self.groups.values()}
         for param, grps in self.dispatch.items():
             for grp in grps:
-                df_table.loc[param, grp] = 'yes'
-
-        df_table = df_table.reset_index()
-        df_table = df_table.rename(columns={'index': 'parameter'})
-        return df_table
+                table[grp].append(param)
+        return table
 
     def get_by_group(self, group_name: str) -> List[str]:
         """
@@ -365,8 +451,7 @@ class ParamTable:
         Returns:
             List[str]: list of parameters
         """
-        _df_table = self.table
-        _param_names = _df_table[_df_table[group_name] == 'yes']['parameter'].tolist()
+        _param_names = self.table[group_name]
         return _param_names
 
 
@@ -410,8 +495,7 @@ def save_parameter(params: ParamSet, save_path: str) -> None:
         save_path (str): save path for parameters
     """
     _saved = {_param: _arg for _param, _arg in vars(params).items()}
-    save_dir = Path(save_path).parents[0]
-    save_dir.mkdir(parents=True, exist_ok=True)
+    os.makedirs(os.path.dirname(save_path) or '.', exist_ok=True)
     with open(save_path, 'w') as f:
         json.dump(_saved, f, indent=4)
 
@@ -457,59 +541,95 @@ def print_parameter(params: ParamSet) -> None:
     _padding = (LINE_LENGTH - len(_footer) + 1) // 2
     _footer = ('-' * _padding) + _footer + ('-' * _padding) + '\n'
 
-    message = ''
-    message += _header
+    # Filter out without deleting attribute of params.
+    _params_dict = {_param: _arg for _param, _arg in vars(params).items() if _param != 'isTrain'}
 
-    _params_dict = vars(params)
-    del _params_dict['isTrain']
+    message = [_header]
     for _param, _arg in _params_dict.items():
         _str_arg = _arg2str(_param, _arg)
-        message += f"{_param:>30}: {_str_arg:<40}\n"
+        message.append(f"{_param:>30}: {_str_arg:<40}\n")
+    message.append(_footer)
+    logger.info(''.join(message))
+
 
-    message += _footer
-    logger.info(message)
+def _lr2str(arg: float) -> str:
+    """
+    Convert learning rate to string.
+
+    Args:
+        arg (float): learning rate
+
+    Returns:
+        str: strings of argument
+    """
+    return 'Default' if arg is None else str(arg)
+
+
+def _gpu_ids2str(arg: List[int]) -> str:
+    """
+    Convert GPU ids to string.
+
+    Args:
+        arg (List[int]): GPU ids
+
+    Returns:
+        str: strings of argument
+    """
+    return 'CPU selected' if arg == [] else f"{arg}  (Primary GPU:{arg[0]})"
+
+
+def _test_splits2str(arg: List[str]) -> str:
+    """
+    Convert splits for test to string.
+
+    Args:
+        arg (List[str]): splits for test
+
+    Returns:
+        str: strings of argument
+    """
+    return ', '.join(arg)
+
+
+def _dataset_info2str(arg: Dict[str, int]) -> str:
+    """
+    Convert number of data for each split to string.
+
+    Args:
+        arg (Dict[str, int]): number of data for each split
+
+    Returns:
+        str: strings of argument
+    """
+    return ', '.join(f"{split}_data={total}" for split, total in arg.items())
+
+
+# Parameters which are printed in their own way
+ARG2STR = {
+    'lr': _lr2str,
+    'gpu_ids': _gpu_ids2str,
+    'test_splits': _test_splits2str,
+    'dataset_info': _dataset_info2str
+}
 
 
 def _arg2str(param: str, arg: Union[str, int, float]) -> str:
-        """
-        Convert argument to string.
+    """
+    Convert argument to string.
 
-        Args:
-            param (str): parameter
-            arg (Union[str, int, float]): argument
+    Args:
+        param (str): parameter
+        arg (Union[str, int, float]): argument
 
-        Returns:
-            str: strings of argument
-        """
-        if param == 'lr':
-            if arg is None:
-                str_arg = 'Default'
-            else:
-                str_arg = str(param)
-            return str_arg
-        elif param == 'gpu_ids':
-            if arg == []:
-                str_arg = 'CPU selected'
-            else:
-                str_arg = f"{arg}  (Primary GPU:{arg[0]})"
-            return str_arg
-        elif param == 'test_splits':
-            str_arg = ', '.join(arg)
-            return str_arg
-        elif param == 'dataset_info':
-            str_arg = ''
-            for i, (split, total) in enumerate(arg.items()):
-                if i < len(arg) - 1:
-                    str_arg += (f"{split}_data={total}, ")
-                else:
-                    str_arg += (f"{split}_data={total}")
-            return str_arg
-        else:
-            if arg is None:
-                str_arg = 'No need'
-            else:
-                str_arg = str(arg)
-            return str_arg
+    Returns:
+        str: strings of argument
+    """
+    if param in ARG2STR:
+        return ARG2STR[param](arg)
+
+    if arg is None:
+        return 'No need'
+    return str(arg)
 
 
 def _check_if_valid_criterion(task: str = None, criterion: str = None) -> None:
@@ -546,9 +666,11 @@ def _train_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
 
     args.project = Path(args.csvpath).stem
     args.gpu_ids = _parse_gpu_ids(args.gpu_ids)
-    args.device = torch.device(f"cuda:{args.gpu_ids[0]}") if args.gpu_ids != [] else torch.device('cpu')
+    args.device = _get_device(args.gpu_ids)
     args.mlp, args.net = _parse_model(args.model)
     args.pretrained = bool(args.pretrained)  # strtobool('False') = 0 (== False)
+    args.compile = bool(args.compile)
+    args.amp = bool(args.amp)
     args.save_datetime_dir = str(Path('results', args.project, 'trials', args.datetime))
 
     # Parse csv
@@ -584,7 +706,17 @@ def _test_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
     """
     args.project = Path(args.csvpath).stem
     args.gpu_ids = _parse_gpu_ids(args.gpu_ids)
-    args.device = torch.device(f"cuda:{args.gpu_ids[0]}") if args.gpu_ids != [] else torch.device('cpu')
+    args.device = _get_device(args.gpu_ids)
+    args.compile = bool(args.compile)
+    args.amp = bool(args.amp)
+    args.scripted = bool(args.scripted)
+
+    # Every process would run all the inference and write the same likelihood.
+    assert (int(os.environ.get('WORLD_SIZE', 1)) == 1), 'Test should be run in a single process, not launched by torchrun.'
+
+    # Scripted network has its weight frozen into constants, which can be neither compiled nor wrapped for multiple GPUs.
+    assert not (args.scripted and args.compile), 'Cannot use both compile and scripted.'
+    assert not (args.scripted and (len(args.gpu_ids) > 1)), 'Scripted network can be used only on CPU or a single GPU.'
 
     # Collect weight paths
     if args.weight_dir is None:
@@ -632,24 +764,25 @@ def _test_parse(args: argparse.Namespace) -> Dict[str, ParamSet]:
             'args_print': _dispatch_by_group(args, 'test_print')
             }
 
-def set_options(datetime_name: str = None, phase: str = None) -> argparse.Namespace:
+def set_options(datetime_name: str = None, phase: str = None, argv: List[str] = None) -> argparse.Namespace:
     """
     Parse options for training or test.
 
     Args:
         datetime_name (str, optional): datetime name. Defaults to None.
         phase (str, optional): train or test. Defaults to None.
+        argv (List[str], optional): arguments to be parsed. If None, sys.argv is parsed. Defaults to None.
 
     Returns:
         argparse.Namespace: arguments
     """
     if phase == 'train':
-        opt = Options(datetime=datetime_name, isTrain=True)
+        opt = Options(datetime=datetime_name, isTrain=True, argv=argv)
         _args = opt.get_args()
         args = _train_parse(_args)
         return args
     else:
-        opt = Options(isTrain=False)
+        opt = Options(isTrain=False, argv=argv)
         _args = opt.get_args()
         args = _test_parse(_args)
         return args
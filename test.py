@@ -2,6 +2,8 @@
 # -*- coding: utf-8 -*-
 
 from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 import torch
 from lib import (
         set_options,
@@ -15,6 +17,34 @@ from lib.component import set_likelihood
 
 logger = BaseLogger.get_logger(__name__)
 
+# Number of batches which can wait to be written into likelihood
+MAX_PENDING_LIKELIHOODS = 2
+
+
+def save_likelihood(likelihood, data, outputs, copied, save_path, as_new):
+    """
+    Make likelihood of batch and write it into csv.
+    This is run in the background while the next batch is forwarded.
+
+    Args:
+        likelihood (Likelihood): likelihood
+        data (Dict): batch data from dataloader, only columns written into likelihood
+        outputs (Dict[str, torch.Tensor]): output of model on CPU
+        copied (torch.cuda.Event): event recorded after copying output to CPU, or None on CPU
+        save_path (Path): path to csv of likelihood
+        as_new (bool): True if a new csv is made, otherwise likelihood is appended
+    """
+    if copied is not None:
+        copied.synchronize()
+
+    # Make a new likelihood every batch
+    df_likelihood = likelihood.make_format(data, outputs)
+
+    if as_new:
+        df_likelihood.to_csv(save_path, index=False)
+    else:
+        df_likelihood.to_csv(save_path, mode='a', index=False, header=False)
+
 
 def main(
         args_model = None,
@@ -32,33 +62,56 @@ def main(
     dataloaders = {split: create_dataloader(args_dataloader, split=split) for split in test_splits}
     likelihood = set_likelihood(args_conf.task, args_conf.num_outputs_for_label)
 
-    for weight_path in args_conf.weight_paths:
-        logger.info(f"Inference ...")
-        model.load_weight(weight_path)
-        model.to_gpu(args_conf.gpu_ids)
-        model.eval()
-
-        for i, split in enumerate(test_splits):
-            for j, data in enumerate(dataloaders[split]):
-                in_data, _ = model.set_data(data)
-
-                with torch.no_grad():
-                    outputs = model(in_data)
-
-                # Make a new likelihood every batch
-                df_likelihood = likelihood.make_format(data, outputs)
-
-                if i + j == 0:
-                    save_dir = Path(save_datetime_dir, 'likelihoods')
-                    save_dir.mkdir(parents=True, exist_ok=True)
-                    save_path = Path(save_dir, 'likelihood_' + Path(weight_path).stem + '.csv')
-                    df_likelihood.to_csv(save_path, index=False)
-                else:
-                    df_likelihood.to_csv(save_path, mode='a', index=False, header=False)
-
-        # Reset the current weight by initializing network.
-        model.init_network()
+    # Likelihood is written in order by a single background thread.
+    executor = ThreadPoolExecutor(max_workers=1)
+    save_dir = Path(save_datetime_dir, 'likelihoods')
+    save_dir.mkdir(parents=True, exist_ok=True)
+    # Keep only columns written into likelihood, not image, while batch waits to be written.
+    likelihood_columns = likelihood.base_column_list + ['labels']
 
+    try:
+        for weight_path in args_conf.weight_paths:
+            logger.info(f"Inference ...")
+            model.load_weight(weight_path)
+            if args_conf.scripted:
+                model.script_network()
+            model.to_gpu(args_conf.gpu_ids)
+            model.eval()
+
+            save_path = Path(save_dir, 'likelihood_' + Path(weight_path).stem + '.csv')
+            pending = deque()
+            for i, split in enumerate(test_splits):
+                for j, data in enumerate(dataloaders[split]):
+                    in_data, _ = model.set_data(data)
+
+                    with torch.no_grad(), model.autocast():
+                        outputs = model(in_data)
+
+                    # Copy output to CPU without waiting for it, so that the next batch is forwarded in the meantime.
+                    # Output may be half precision under autocast.
+                    outputs = {label_name: output.to('cpu', torch.float32, non_blocking=True) for label_name, output in outputs.items()}
+                    if model.device.type == 'cuda':
+                        # Record on the stream of the device copying output, which may not be the current device.
+                        copied = torch.cuda.Event()
+                        copied.record(torch.cuda.current_stream(model.device))
+                    else:
+                        copied = None
+
+                    # Wait for the oldest batch if writing falls behind, and raise error in the background if any.
+                    if len(pending) == MAX_PENDING_LIKELIHOODS:
+                        pending.popleft().result()
+
+                    _data = {column: data[column] for column in likelihood_columns}
+                    pending.append(executor.submit(save_likelihood, likelihood, _data, outputs, copied, save_path, (i + j == 0)))
+
+            # Wait for likelihood to be written.
+            while pending:
+                pending.popleft().result()
+
+            # Reset the current weight by initializing network.
+            model.init_network()
+    finally:
+        executor.shutdown()
 
 if __name__ == '__main__':
     try:
@@ -3,6 +3,8 @@
 
 import datetime
 import torch
+import torch.distributed as dist
+from torch.utils.data.distributed import DistributedSampler
 from lib import (
         set_options,
         create_model,
@@ -40,9 +42,14 @@ def main(
     model.to_gpu(args_conf.gpu_ids)
     dataloaders = {split: create_dataloader(args_dataloader, split=split) for split in ['train', 'val']}
 
+    # When DistributedDataParallel, only the primary process saves results.
+    isDistributed = dist.is_available() and dist.is_initialized()
+    isPrimary = (not isDistributed) or (dist.get_rank() == 0)
+
     criterion = set_criterion(args_conf.criterion, args_conf.device)
-    loss_store = set_loss_store(args_conf.label_list, args_conf.epochs, args_conf.dataset_info)
+    loss_store = set_loss_store(args_conf.label_list, args_conf.epochs, args_conf.dataset_info, args_conf.device)
     optimizer = set_optimizer(args_conf.optimizer, model.network, args_conf.lr)
+    scaler = model.grad_scaler()
 
     for epoch in range(1, args_conf.epochs + 1):
         for phase in ['train', 'val']:
@@ -54,33 +61,43 @@ def main(
                 raise ValueError(f"Invalid phase: {phase}.")
 
             split_dataloader = dataloaders[phase]
+            if isinstance(split_dataloader.sampler, DistributedSampler):
+                split_dataloader.sampler.set_epoch(epoch)
+
             for i, data in enumerate(split_dataloader):
-                optimizer.zero_grad()
+                optimizer.zero_grad(set_to_none=True)
 
                 in_data, labels = model.set_data(data)
                 with torch.set_grad_enabled(phase == 'train'):
-                    outputs = model(in_data)
-                    losses = criterion(outputs, labels)
+                    with model.autocast():
+                        outputs = model(in_data)
+                        losses = criterion(outputs, labels)
 
                     if phase == 'train':
                         loss = losses['total']
-                        loss.backward()
-                        optimizer.step()
+                        scaler.scale(loss).backward()
+                        scaler.step(optimizer)
+                        scaler.update()
 
                 loss_store.store(phase, losses, batch_size=len(data['imgpath']))
 
         loss_store.cal_epoch_loss(at_epoch=epoch)
-        loss_store.print_epoch_loss(at_epoch=epoch)
+        if isPrimary:
+            loss_store.print_epoch_loss(at_epoch=epoch)
         if loss_store.is_val_loss_updated():
             model.store_weight(at_epoch=loss_store.get_best_epoch())
-            if (epoch > 1) and (save_weight_policy == 'each'):
+            if (epoch > 1) and (save_weight_policy == 'each') and isPrimary:
                 model.save_weight(save_datetime_dir, as_best=False)
 
-    save_parameter(args_save, save_datetime_dir + '/' + 'parameters.json')
-    loss_store.save_learning_curve(save_datetime_dir)
-    model.save_weight(save_datetime_dir, as_best=True)
-    if isMLP:
-        dataloaders['train'].dataset.save_scaler(save_datetime_dir + '/' + 'scaler.pkl')
+    if isPrimary:
+        save_parameter(args_save, save_datetime_dir + '/' + 'parameters.json')
+        loss_store.save_learning_curve(save_datetime_dir)
+        model.save_weight(save_datetime_dir, as_best=True)
+        if isMLP:
+            dataloaders['train'].dataset.save_scaler(save_datetime_dir + '/' + 'scaler.pkl')
+
+    if isDistributed:
+        dist.destroy_process_group()
 
 
 if __name__ == '__main__':